@@ -1,25 +1,36 @@
+import codecs
 import json
 import os
+import shlex
+import shutil
 import subprocess
+import tempfile
 import traceback
 from datetime import datetime
-from functools import partial
 
 import redis
 
 from agent.job import connection
+from agent.utils import json_dumps
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Optional, Any
+    from typing import Any, Dict, Optional, Tuple
     from agent.job import Job, Step
 
 
+CHUNK_SIZE = 64 * 1024
+
+
 class Base:
     if TYPE_CHECKING:
         job_record: "Optional[Job]"
         step_record: "Optional[Step]"
 
+    # Shared across instances, Server, Bench and Site objects are
+    # recreated for every request but read the same config files
+    _config_cache: "Dict[str, Tuple[Tuple[int, int, int], str]]" = {}
+
     def __init__(self):
         self.directory = None
         self.config_file = None
@@ -42,7 +53,9 @@ class Base:
         start = datetime.now()
         self.skip_output_log = skip_output_log
         self.data = {
-            "command": command,
+            "command": command
+            if isinstance(command, str)
+            else " ".join(map(shlex.quote, command)),
             "directory": directory,
             "start": start,
             "status": "Running",
@@ -85,20 +98,22 @@ class Base:
         self, command, directory, input, executable, non_zero_throw=True
     ):
         # Start a child process and start reading output immediately
+        # Commands passed as a list of arguments are run without a shell
         with subprocess.Popen(
             command,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             stdin=subprocess.PIPE if input else None,
             cwd=directory,
-            shell=True,
+            shell=isinstance(command, str),
+            bufsize=-1,
             executable=executable,
         ) as process:
             if input:
                 process._stdin_write(input.encode())
 
             output = self.parse_output(process)
-            returncode = process.poll()
+            returncode = process.wait()
             # This is equivalent of check=True
             # Raise an exception if the process returns a non-zero return code
             if non_zero_throw and returncode:
@@ -111,28 +126,32 @@ class Base:
         if not process.stdout:
             return ""
 
-        line = b""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        line = ""
         lines = []
         # This is equivalent of remove_crs
         # Make sure output matches what'll be shown in the terminal
         # This won't work for top, htop etc, but good enough to handle progress bars
-        for char in iter(partial(process.stdout.read, 1), b""):
-            if char == b"" and process.poll() is not None:
+        while True:
+            # read1 returns whatever is available instead of waiting for the
+            # whole chunk, so progress is still published as it arrives
+            chunk = process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
                 break
-            elif char == b"\r":
-                # Publish output and then wipe current line.
-                # Include the overwritten line in the output
-                self.publish_lines(lines + [line.decode(errors="replace")])
-                line = b""
-            elif char == b"\n":
-                lines.append(line.decode(errors="replace"))
-                line = b""
-                self.publish_lines(lines)
-            else:
-                line += char
 
+            *complete, line = (line + decoder.decode(chunk)).split("\n")
+            # Only the text after the last carriage return stays visible
+            lines.extend(part.rpartition("\r")[2] for part in complete)
+
+            # Publish output and then wipe overwritten part of current line.
+            # Include the overwritten line in the output if nothing follows it
+            overwritten, _, line = line.rpartition("\r")
+            current = line or overwritten.rpartition("\r")[2]
+            self.publish_lines(lines + [current] if current else lines)
+
+        line += decoder.decode(b"", final=True)
         if line:
-            lines.append(line.decode(errors="replace"))
+            lines.append(line.rpartition("\r")[2])
         self.publish_lines(lines)
         return "\n".join(lines)
 
@@ -143,7 +162,7 @@ class Base:
 
     def publish_data(self, data: "Any"):
         if not isinstance(data, str):
-            data = json.dumps(data, default=str)
+            data = json_dumps(data, default=str)
 
         self.data.update({"output": data})
         self.update_redis()
@@ -152,7 +171,7 @@ class Base:
         if not (redis_key := self.get_redis_key()):
             return
 
-        value = json.dumps(self.data, default=str)
+        value = json_dumps(self.data, default=str)
         self.push_redis_value(redis_key, value)
         self.redis.expire(redis_key, 60 * 60 * 6)
 
@@ -185,59 +204,85 @@ class Base:
 
     @property
     def config(self):
-        with open(self.config_file, "r") as f:
-            return json.load(f)
+        return json.loads(self._read_config(self.config_file))
 
     def setconfig(self, value, indent=1):
-        with open(self.config_file, "w") as f:
-            json.dump(value, f, indent=indent, sort_keys=True)
+        self._write_config(self.config_file, value, indent)
+
+    def _write_config(self, path, value, indent):
+        """Atomically replaces a config file with value serialized as JSON.
+
+        Readers in other processes never see a truncated file, they get
+        either the old or the new contents. Config files are small, so
+        stdlib json is used to keep wide integers and NaN intact.
+        """
+        directory, filename = os.path.split(path)
+        fd, temp = tempfile.mkstemp(prefix=f".{filename}.", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f, indent=indent, sort_keys=True)
+            if os.path.exists(path):
+                shutil.copymode(path, temp)
+            os.replace(temp, path)
+        except Exception:
+            os.remove(temp)
+            raise
+        self._config_cache.pop(path, None)
+
+    def _read_config(self, path):
+        """Returns contents of a config file, reading it only if it changed.
+
+        The raw contents are cached instead of the parsed dict so every
+        caller gets a fresh copy that it's free to mutate.
+        """
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._config_cache.get(path)
+        if not cached or cached[0] != key:
+            with open(path, "r") as f:
+                cached = self._config_cache[path] = (key, f.read())
+        return cached[1]
 
     def log(self):
         data = self.data.copy()
         if self.skip_output_log:
             data.update({"output": ""})
-        print(json.dumps(data, default=str))
+        print(json_dumps(data, default=str))
         self.update_redis()
 
     @property
     def logs(self):
-        def path(file):
-            return os.path.join(self.logs_directory, file)
-
-        def modified_time(file):
-            return os.path.getctime(path(file))
-
         try:
-            log_files = sorted(
-                os.listdir(self.logs_directory),
-                key=modified_time,
-                reverse=True,
-            )
-            payload = []
-
-            for x in log_files:
-                stats = os.stat(path(x))
-                payload.append(
-                    {
-                        "name": x,
-                        "size": stats.st_size / 1000,
-                        "created": str(datetime.fromtimestamp(stats.st_ctime)),
-                        "modified": str(
-                            datetime.fromtimestamp(stats.st_mtime)
-                        ),
-                    }
-                )
-
-            return payload
-
+            # DirEntry caches its stat result, the same one is used for
+            # sorting and for building the payload
+            with os.scandir(self.logs_directory) as it:
+                log_files = [(x.name, x.stat()) for x in it if x.is_file()]
         except FileNotFoundError:
             return []
 
+        log_files.sort(key=lambda x: x[1].st_ctime, reverse=True)
+        return [
+            {
+                "name": name,
+                "size": stats.st_size / 1000,
+                "created": str(datetime.fromtimestamp(stats.st_ctime)),
+                "modified": str(datetime.fromtimestamp(stats.st_mtime)),
+            }
+            for name, stats in log_files
+        ]
+
     def retrieve_log(self, name):
-        if name not in {x["name"] for x in self.logs}:
+        # Only serve files listed in the logs directory, without building
+        # the whole logs payload (and stat-ing every file) to check that
+        try:
+            with os.scandir(self.logs_directory) as it:
+                if not any(x.name == name and x.is_file() for x in it):
+                    return ""
+        except FileNotFoundError:
             return ""
         log_file = os.path.join(self.logs_directory, name)
-        return open(log_file).read()
+        with open(log_file) as f:
+            return f.read()
 
 
 class AgentException(Exception):
@@ -1,29 +1,45 @@
+import copy
 import hashlib
 import json
 import os
+import re
+import shlex
 import shutil
 import string
 import tempfile
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from filelock import FileLock
 from random import choices
-from glob import glob
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from agent.app import App
 from agent.base import AgentException, Base
 from agent.exceptions import SiteNotExistsException
 from agent.job import job, step
 from agent.site import Site
-from agent.utils import download_file, get_size
+from agent.utils import download_file, get_size, json_loads
+
+# Shared across status checks so keep-alive connections to sites are reused
+# instead of doing a fresh TLS handshake for every ping
+http_session = requests.Session()
+http_session.mount(
+    "https://", HTTPAdapter(pool_connections=64, pool_maxsize=64)
+)
 
 
 class Bench(Base):
+    # Running worker task of each swarm bench, looked up once instead of
+    # running `docker service ps` before every docker exec
+    _worker_containers: "Dict[str, str]" = {}
+
     def __init__(self, name, server, mounts=None):
         self.name = name
         self.server = server
@@ -39,6 +55,8 @@ class Bench(Base):
         self.host = self.config.get("db_host", "localhost")
         self.docker_image = self.bench_config.get("docker_image")
         self.mounts = mounts
+        self._apps_cache = None
+        self._sites_cache = None
         if not (
             os.path.isdir(self.directory)
             and os.path.exists(self.sites_directory)
@@ -47,6 +65,12 @@ class Bench(Base):
         ):
             raise Exception
 
+    def __getstate__(self):
+        # Don't pickle cached App and Site objects along with enqueued jobs
+        state = self.__dict__.copy()
+        state.update({"_apps_cache": None, "_sites_cache": None})
+        return state
+
     @step("Deploy Bench")
     def deploy(self):
         return self.start()
@@ -68,47 +92,49 @@ class Bench(Base):
             since = max_retention_time
 
         info = {}
-        usage_data = []
-        log_files = glob(
-            os.path.join(
-                self.server.directory,
-                "logs",
-                f"{self.server.name}-usage-*.json.log",
-            )
-        )
-        valid_files = [
-            file for file in log_files if os.stat(file).st_mtime > since
-        ]
+        usage = defaultdict(list)
+        timezones = {}
+        log_files = []
+        logs_directory = os.path.join(self.server.directory, "logs")
+        prefix, suffix = f"{self.server.name}-usage-", ".json.log"
+        try:
+            entries = os.scandir(logs_directory)
+        except FileNotFoundError:
+            entries = None
+
+        if entries is not None:
+            with entries:
+                for entry in entries:
+                    if not (
+                        entry.name.startswith(prefix)
+                        and entry.name.endswith(suffix)
+                    ):
+                        continue
+                    # Logs removed by a concurrent job are simply skipped
+                    try:
+                        if since >= entry.stat().st_mtime > max_retention_time:
+                            print(f"Deleting {entry.path}")
+                            os.remove(entry.path)
+                        else:
+                            log_files.append(entry.path)
+                    except FileNotFoundError:
+                        continue
 
         for file in log_files:
-            if (file not in valid_files) and (
-                os.stat(file).st_mtime > max_retention_time
-            ):
-                print(f"Deleting {file}")
-                os.remove(file)
-            else:
-                try:
-                    usage_data.extend(json.load(open(file)))
-                except json.decoder.JSONDecodeError:
-                    print(f"Error loading JSON from {file}")
-
-        for site in self.sites.values():
             try:
-                timezone_data = {
-                    d["timestamp"]: d["timezone"]
-                    for d in usage_data
-                    if d["site"] == site.name
-                }
-                timezone = timezone_data[max(timezone_data)]
-            except Exception:
-                timezone = None
-
-            if not (usage_data and timezone):
-                timezone = site.timezone
-
-            info[site.name] = {
-                "config": site.config,
-                "usage": [
+                with open(file, "rb") as f:
+                    usage_data = json_loads(f.read())
+            except FileNotFoundError:
+                continue
+            except json.decoder.JSONDecodeError:
+                print(f"Error loading JSON from {file}")
+                continue
+
+            # Bucket records by site in a single pass, keeping the timezone
+            # from the latest record of every site
+            for d in usage_data:
+                site = d["site"]
+                usage[site].append(
                     {
                         "database": d["database"],
                         "public": d["public"],
@@ -116,9 +142,18 @@ class Bench(Base):
                         "backups": d["backups"],
                         "timestamp": d["timestamp"],
                     }
-                    for d in usage_data
-                    if d["site"] == site.name
-                ],
+                )
+                if d["timestamp"] >= timezones.get(site, ("", None))[0]:
+                    timezones[site] = (d["timestamp"], d["timezone"])
+
+        for site in self.sites.values():
+            timezone = timezones.get(site.name, (None, None))[1]
+            if not timezone:
+                timezone = site.timezone
+
+            info[site.name] = {
+                "config": site.config,
+                "usage": usage.get(site.name, []),
                 "timezone": timezone,
             }
 
@@ -144,31 +179,83 @@ class Bench(Base):
         )
 
     def docker_execute(
-        self, command, input=None, subdir=None, non_zero_throw=True
+        self,
+        command,
+        input=None,
+        subdir=None,
+        non_zero_throw=True,
+        shell=False,
     ):
         interactive = "-i" if input else ""
         workdir = "/home/frappe/frappe-bench"
         if subdir:
             workdir = os.path.join(workdir, subdir)
 
-        if self.bench_config.get("single_container"):
-            command = (
+        def _execute(container):
+            command_line = (
                 f"docker exec -w {workdir} "
-                f"{interactive} {self.name} {command}"
+                f"{interactive} {container} {command}"
+            )
+            # Internal commands don't need a shell, skip spawning one.
+            # Arbitrary commands (e.g. from Press) may rely on pipes,
+            # redirects or variables and keep running through the shell
+            return self.execute(
+                command_line if shell else shlex.split(command_line),
+                input=input,
+                non_zero_throw=non_zero_throw,
+            )
+
+        if self.bench_config.get("single_container"):
+            return _execute(self.name)
+
+        def _is_stale(data, container):
+            # Only docker's own exec errors mean the command never ran,
+            # anything else printing these words must not be run again.
+            # Swarm keeps exited containers of replaced tasks around, exec
+            # into those fails with "is not running" and the container ID
+            output = data["output"].strip()
+            return bool(data["returncode"]) and bool(
+                re.fullmatch(
+                    "Error(?: response from daemon)?: No such container: "
+                    + re.escape(container),
+                    output,
+                )
+                or re.fullmatch(
+                    "Error response from daemon: [Cc]ontainer [0-9a-f]{64} "
+                    "is not running",
+                    output,
+                )
             )
+
+        container = self._worker_container()
+        try:
+            result = _execute(container)
+        except AgentException as e:
+            if not _is_stale(e.data, container):
+                raise
         else:
-            service = f"{self.name}_worker_default"
+            if not _is_stale(result, container):
+                return result
+        # Task was replaced since it was looked up, e.g. by a deploy
+        return _execute(self._worker_container(refresh=True))
+
+    def _worker_container(self, refresh=False):
+        service = f"{self.name}_worker_default"
+        if refresh or service not in self._worker_containers:
             task = self.execute(
-                "docker service ps -f desired-state=Running -q --no-trunc "
-                f"{service}"
+                [
+                    "docker",
+                    "service",
+                    "ps",
+                    "-f",
+                    "desired-state=Running",
+                    "-q",
+                    "--no-trunc",
+                    service,
+                ]
             )["output"].split()[0]
-            command = (
-                f"docker exec -w {workdir} "
-                f"{interactive} {service}.1.{task} {command}"
-            )
-        return self.execute(
-            command, input=input, non_zero_throw=non_zero_throw
-        )
+            self._worker_containers[service] = f"{service}.1.{task}"
+        return self._worker_containers[service]
 
     @step("New Site")
     def bench_new_site(self, name, mariadb_root_password, admin_password):
@@ -184,6 +271,7 @@ class Bench(Base):
                 f"--db-name {site_database} {name}"
             )
         finally:
+            self._sites_cache = None
             self.drop_mariadb_user(name, mariadb_root_password, site_database)
 
     @job("Rename Site", priority="high")
@@ -277,17 +365,17 @@ class Bench(Base):
                 with open(target_file) as f:
                     for line in f.readlines():
                         try:
-                            lines.append(json.loads(line))
+                            lines.append(json_loads(line))
                         except Exception:
                             traceback.print_exc()
 
             now = datetime.now().timestamp()
-            for file in os.listdir(logs_directory):
-                path = os.path.join(logs_directory, file)
-                if file.endswith("-monitor.json.log") and (
-                    now - os.stat(path).st_mtime
-                ) > (7 * 86400):
-                    os.remove(path)
+            with os.scandir(logs_directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith("-monitor.json.log") and (
+                        now - entry.stat().st_mtime
+                    ) > (7 * 86400):
+                        os.remove(entry.path)
         except FileNotFoundError:
             pass
         except Exception:
@@ -316,18 +404,25 @@ class Bench(Base):
             return inactive
 
         def _inactive_web_sites(bench):
-            inactive = []
-            session = requests.Session()
-            for site in bench.sites.keys():
+            def _ping(site):
                 url = f"https://{site}/api/method/ping"
                 try:
-                    result = session.get(url)
+                    result = http_session.get(url, timeout=(5, 15))
                 except Exception as e:
                     result = None
                     print("Ping Failed", url, e)
-                if not result or result.status_code != 200:
-                    inactive.append(site)
-            return inactive
+                return site, result
+
+            # Pings are network bound, run them concurrently so status
+            # takes about as long as the slowest site instead of all of them
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                results = list(executor.map(_ping, bench.sites.keys()))
+
+            return [
+                site
+                for site, result in results
+                if not result or result.status_code != 200
+            ]
 
         status = {
             "sites": {
@@ -410,6 +505,7 @@ class Bench(Base):
                 f"--archived-sites-path archived {name}"
             )
         finally:
+            self._sites_cache = None
             self.drop_mariadb_user(name, mariadb_root_password, site_database)
 
     @step("Download Backup Files")
@@ -444,7 +540,6 @@ class Bench(Base):
         if os.path.exists(site_directory):
             self.bench_archive_site(name, mariadb_root_password, force)
         self.setup_nginx()
-        self.server._reload_nginx()
 
     @step("Bench Setup NGINX")
     def setup_nginx(self):
@@ -462,7 +557,9 @@ class Bench(Base):
         domains = {}
         sites = []
         for site in self.valid_sites.values():
-            sites.append(site)
+            # host is overwritten for wildcard domains below, keep the
+            # cached Site objects intact
+            sites.append(copy.copy(site))
             for domain in site.config.get("domains", []):
                 domains[domain] = site.name
 
@@ -539,6 +636,15 @@ class Bench(Base):
 
     @property
     def apps(self):
+        # App runs git to validate the directory, only redo that when
+        # apps.txt or the apps directory have changed
+        key = (
+            os.stat(self.apps_file).st_mtime_ns,
+            os.stat(os.path.join(self.directory, "apps")).st_mtime_ns,
+        )
+        if self._apps_cache and self._apps_cache[0] == key:
+            return self._apps_cache[1].copy()
+
         with open(self.apps_file, "r") as f:
             apps_list = f.read().split("\n")
 
@@ -548,7 +654,8 @@ class Bench(Base):
                 apps[directory] = App(directory, self)
             except Exception:
                 pass
-        return apps
+        self._apps_cache = (key, apps)
+        return apps.copy()
 
     @step("Update Bench Configuration")
     def update_config(self, common_site_config, bench_config):
@@ -673,7 +780,6 @@ class Bench(Base):
         if os.path.exists(self.directory):
             self.remove_code_server()
             self.setup_nginx()
-            self.server._reload_nginx()
 
     @step("Remove Code Server")
     def remove_code_server(self):
@@ -748,14 +854,16 @@ class Bench(Base):
                 "--resolve-image=never --with-registry-auth "
                 f"--compose-file docker-compose.yml {self.name} "
             )
-        return self.execute(command)
+            self._worker_containers.pop(f"{self.name}_worker_default", None)
+        return self.execute(shlex.split(command))
 
     def stop(self):
         if self.bench_config.get("single_container"):
-            self.execute(f"docker stop {self.name}")
-            return self.execute(f"docker rm {self.name}")
+            self.execute(["docker", "stop", self.name])
+            return self.execute(["docker", "rm", self.name])
         else:
-            return self.execute(f"docker stack rm {self.name}")
+            self._worker_containers.pop(f"{self.name}_worker_default", None)
+            return self.execute(["docker", "stack", "rm", self.name])
 
     @step("Stop Bench")
     def _stop(self):
@@ -820,11 +928,17 @@ class Bench(Base):
         return self._sites(validate_configs=True)
 
     def _sites(self, validate_configs=False) -> Dict[str, Site]:
+        key = os.stat(self.sites_directory).st_mtime_ns
+        if self._sites_cache and self._sites_cache[0] == key:
+            return self._sites_cache[1].copy()
+
         sites = {}
+        valid = True
         for directory in os.listdir(self.sites_directory):
             try:
                 sites[directory] = Site(directory, self)
             except json.decoder.JSONDecodeError as jde:
+                valid = False
                 output = self.readable_jde_err(
                     f"Error parsing JSON in {directory}", jde
                 )
@@ -833,7 +947,11 @@ class Bench(Base):
                 )  # exit 1 to make sure the job fails and shows output
             except Exception:
                 pass
-        return sites
+
+        # Corrupt configs must be reported on every call, don't cache those
+        if valid:
+            self._sites_cache = (key, sites)
+        return sites.copy()
 
     def get_site(self, site):
         try:
@@ -859,12 +977,10 @@ class Bench(Base):
 
     @property
     def bench_config(self):
-        with open(self.bench_config_file, "r") as f:
-            return json.load(f)
+        return json.loads(self._read_config(self.bench_config_file))
 
     def set_bench_config(self, value, indent=1):
-        with open(self.bench_config_file, "w") as f:
-            json.dump(value, f, indent=indent, sort_keys=True)
+        self._write_config(self.bench_config_file, value, indent)
 
     @job("Patch App")
     def patch_app(
@@ -1,6 +1,6 @@
 import datetime
-import json
 import traceback
+from functools import lru_cache
 
 import wrapt
 from peewee import (
@@ -16,6 +16,8 @@ from peewee import (
 from redis import Redis
 from rq import Queue, get_current_job
 
+from agent.utils import json_dumps
+
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -29,19 +31,23 @@ agent_database = SqliteDatabase(
     pragmas={
         "journal_mode": "wal",
         "synchronous": "normal",
+        "cache_size": -64000,
         "mmap_size": 2**32 - 1,
         "page_size": 8192,
     },
 )
 
 
+@lru_cache(maxsize=None)
 def connection():
     from agent.server import Server
 
+    # Redis clients are thread safe and pool their connections, share one
     port = Server().config["redis_port"]
     return Redis(port=port)
 
 
+@lru_cache(maxsize=None)
 def queue(name):
     return Queue(name, connection=connection())
 
@@ -58,11 +64,11 @@ class Action:
 
     def success(self, data):
         self.model.status = "Success"
-        self.model.data = json.dumps(data, default=str)
+        self.model.data = json_dumps(data, default=str)
         self.end()
 
     def failure(self, data):
-        self.model.data = json.dumps(data, default=str)
+        self.model.data = json_dumps(data, default=str)
         self.model.status = "Failure"
         self.end()
 
@@ -100,7 +106,7 @@ class Job(Action):
         self.model.name = name
         self.model.status = "Pending"
         self.model.enqueue = datetime.datetime.now()
-        self.model.data = json.dumps(
+        self.model.data = json_dumps(
             {
                 "function": function.__func__.__name__,
                 "args": args,
@@ -191,7 +197,7 @@ class JobModel(Model):
             (3, "Failure"),
         ]
     )
-    agent_job_id = CharField(null=True)
+    agent_job_id = CharField(null=True, index=True)
     data = TextField(null=True, default="{}")
 
     enqueue = DateTimeField(default=datetime.datetime.now)
@@ -202,6 +208,9 @@ class JobModel(Model):
 
     class Meta:
         database = agent_database
+        indexes = ((("status", "enqueue"), False),)
+        # Status transitions only touch a few columns, don't rewrite data
+        only_save_dirty = True
 
 
 class StepModel(Model):
@@ -218,6 +227,7 @@ class StepModel(Model):
 
     class Meta:
         database = agent_database
+        only_save_dirty = True
 
 
 class PatchLogModel(Model):
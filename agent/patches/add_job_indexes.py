@@ -0,0 +1,5 @@
+def execute():
+    """add indexes used to look up JobModel by status and agent_job_id"""
+    from agent.job import JobModel
+
+    JobModel._schema.create_indexes(safe=True)
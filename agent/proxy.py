@@ -243,7 +243,7 @@ class Proxy(Server):
 
     @step("Reload NGINX")
     def reload_nginx(self):
-        return self.execute("sudo systemctl reload nginx")
+        return self._reload_nginx()
 
     @job("Reload NGINX Job")
     def reload_nginx_job(self):
@@ -6,6 +6,7 @@ import time
 from datetime import datetime
 from typing import Dict, List
 
+from filelock import FileLock
 from jinja2 import Environment, PackageLoader
 from passlib.hash import pbkdf2_sha256 as pbkdf2
 from peewee import MySQLDatabase
@@ -15,6 +16,7 @@ from agent.bench import Bench
 from agent.job import Job, Step, job, step
 from agent.site import Site
 from agent.patch_handler import run_patches
+from agent.utils import json_loads
 from agent.exceptions import BenchNotExistsException
 
 
@@ -765,7 +767,34 @@ class Server(Base):
         )
 
     def _reload_nginx(self):
-        return self.execute("sudo systemctl reload nginx")
+        # Concurrent jobs queue up on the lock. A reload that started after
+        # this call and succeeded already picked up our changes, so don't
+        # reload again. Counters are used instead of timestamps so clock
+        # steps can't cause skipped reloads
+        requested = self._nginx_reloads()["started"]
+        with FileLock(os.path.join(self.directory, "nginx.reload.lock")):
+            reloads = self._nginx_reloads()
+            if reloads["reloaded"] > requested:
+                return None
+
+            reloads["started"] += 1
+            self._write_config(self._nginx_reloads_file, reloads, 1)
+            output = self.execute("sudo systemctl reload nginx")
+            # Only count the reload once it succeeded, callers waiting on
+            # the lock must reload themselves if it failed
+            reloads["reloaded"] = reloads["started"]
+            self._write_config(self._nginx_reloads_file, reloads, 1)
+            return output
+
+    @property
+    def _nginx_reloads_file(self):
+        return os.path.join(self.directory, "nginx.reload.json")
+
+    def _nginx_reloads(self):
+        try:
+            return json_loads(self._read_config(self._nginx_reloads_file))
+        except FileNotFoundError:
+            return {"started": 0, "reloaded": 0}
 
     def _render_template(self, template, context, outfile, options=None):
         if options is None:
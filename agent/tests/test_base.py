@@ -0,0 +1,66 @@
+import unittest
+from unittest.mock import patch
+
+from agent.base import Base
+
+
+class FakeStdout:
+    """Binary pipe handing out preset chunks from read1."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read1(self, size=-1):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+class FakeProcess:
+    def __init__(self, chunks):
+        self.stdout = FakeStdout(chunks)
+
+
+class TestBase(unittest.TestCase):
+    """Tests for class methods of Base."""
+
+    def setUp(self):
+        self.base = Base()
+        self.published = []
+        patcher = patch.object(
+            Base,
+            "publish_lines",
+            new=lambda _, lines: self.published.append(list(lines)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _parse(self, *chunks):
+        return self.base.parse_output(FakeProcess(chunks))
+
+    def test_parse_output_keeps_text_after_carriage_return(self):
+        """Ensure only the last overwrite of a line is kept."""
+        output = self._parse(b"10%\r50%", b"\r100%\ndone\n")
+        self.assertEqual(output, "100%\ndone")
+        self.assertIn(["50%"], self.published)
+
+    def test_parse_output_crlf_wipes_line(self):
+        """Ensure \\r\\n leaves an empty line, like a terminal would."""
+        self.assertEqual(self._parse(b"a\r\nb\n"), "\nb")
+        self.assertEqual(self._parse(b"a\r", b"\nb\n"), "\nb")
+
+    def test_parse_output_trailing_carriage_return(self):
+        """Ensure a line overwritten at the end is published, not kept."""
+        output = self._parse(b"first\nprogress\r")
+        self.assertEqual(output, "first")
+        self.assertIn(["first", "progress"], self.published)
+
+    def test_parse_output_multibyte_character_split_across_chunks(self):
+        """Ensure a UTF-8 sequence split between reads is decoded once."""
+        output = self._parse(b"caf\xc3", b"\xa9\n", b"na\xc3\xafve")
+        self.assertEqual(output, "café\nnaïve")
+        self.assertNotIn("�", output)
+
+    def test_parse_output_without_stdout(self):
+        """Ensure a process without a stdout pipe yields no output."""
+        process = FakeProcess([])
+        process.stdout = None
+        self.assertEqual(self.base.parse_output(process), "")
@@ -1,5 +1,6 @@
 import json
 import os
+import pickle
 import shutil
 import unittest
 from unittest.mock import patch
@@ -133,3 +134,144 @@ class TestSite(unittest.TestCase):
             bench.valid_sites[site_name]
         except KeyError:
             self.fail("Site not found in bench.sites")
+
+    def test_docker_execute_refreshes_replaced_worker_task(self):
+        """Ensure a stale cached swarm task is looked up again."""
+        bench = self._get_test_bench()
+        tasks = iter(["old-task", "new-task"])
+        commands = []
+
+        def execute(command, input=None, non_zero_throw=True):
+            commands.append(command)
+            if command[:3] == ["docker", "service", "ps"]:
+                return {"output": next(tasks), "returncode": 0}
+            if "test-bench_worker_default.1.old-task" in command:
+                data = {
+                    "output": "Error response from daemon: container "
+                    f"{'0' * 64} is not running\n",
+                    "returncode": 1,
+                }
+                raise AgentException(data)
+            return {"output": "ok", "returncode": 0}
+
+        with patch.dict(Bench._worker_containers, clear=True), patch.object(
+            bench, "execute", new=execute
+        ):
+            self.assertEqual(
+                bench.docker_execute("bench doctor")["output"], "ok"
+            )
+            self.assertEqual(
+                Bench._worker_containers["test-bench_worker_default"],
+                "test-bench_worker_default.1.new-task",
+            )
+            bench.docker_execute("bench doctor")
+
+        service_lookups = [c for c in commands if c[1] == "service"]
+        self.assertEqual(len(service_lookups), 2)
+        self.assertEqual(len(commands), 5)
+
+    def test_docker_execute_keeps_shell_for_arbitrary_commands(self):
+        """Ensure shell=True runs the command line through the shell."""
+        bench = self._get_test_bench()
+        commands = []
+
+        def execute(command, input=None, non_zero_throw=True):
+            commands.append(command)
+            return {"output": "ok", "returncode": 0}
+
+        with patch.object(
+            Bench, "bench_config", new={"single_container": True}
+        ), patch.object(bench, "execute", new=execute):
+            bench.docker_execute("ls | wc -l", shell=True)
+            bench.docker_execute("bench doctor")
+
+        self.assertEqual(
+            commands[0],
+            "docker exec -w /home/frappe/frappe-bench  test-bench ls | wc -l",
+        )
+        self.assertIsInstance(commands[1], list)
+
+    def test_sites_property_of_bench_picks_up_new_site_after_cached_read(
+        self,
+    ):
+        """Ensure a site created after a cached read is listed."""
+        bench = self._get_test_bench()
+        self._create_test_site("first-site.frappe.cloud")
+        self._make_site_config("first-site.frappe.cloud")
+        self.assertEqual(list(bench.sites), ["first-site.frappe.cloud"])
+
+        self._create_test_site("second-site.frappe.cloud")
+        self._make_site_config("second-site.frappe.cloud")
+        self.assertEqual(
+            sorted(bench.sites),
+            ["first-site.frappe.cloud", "second-site.frappe.cloud"],
+        )
+
+    def test_valid_sites_property_of_bench_throws_on_every_call(self):
+        """Ensure a corrupt site config isn't hidden by the sites cache."""
+        bench = self._get_test_bench()
+        site_name = "corrupt-site.frappe.cloud"
+        self._create_test_site(site_name)
+        self._make_site_config(site_name, content="{")
+        with patch.object(Bench, "update_redis", new=lambda x: None):
+            for _ in range(2):
+                with self.assertRaises(AgentException):
+                    bench.valid_sites
+
+    def test_config_property_of_bench_returns_value_set_by_setconfig(self):
+        """Ensure setconfig invalidates the cached common site config."""
+        bench = self._get_test_bench()
+        self.assertEqual(bench.config, {})
+        bench.setconfig({"background_workers": 2})
+        self.assertEqual(bench.config, {"background_workers": 2})
+
+    def test_config_property_of_bench_keeps_wide_integers(self):
+        """Ensure config round trips don't turn wide integers into floats."""
+        bench = self._get_test_bench()
+        bench.setconfig({"limit": 123456789012345678901234567890})
+        self.assertEqual(
+            bench.config, {"limit": 123456789012345678901234567890}
+        )
+
+    def test_pickled_bench_doesnt_carry_cached_sites(self):
+        """Ensure enqueued jobs don't pickle cached Site objects."""
+        bench = self._get_test_bench()
+        site_name = "some-site.frappe.cloud"
+        self._create_test_site(site_name)
+        self._make_site_config(site_name)
+        bench.sites
+        self.assertIsNotNone(bench._sites_cache)
+
+        unpickled = pickle.loads(pickle.dumps(bench))
+        self.assertIsNone(unpickled._sites_cache)
+        self.assertIsNone(unpickled._apps_cache)
+        self.assertEqual(list(unpickled.sites), [site_name])
+
+    def test_docker_execute_doesnt_retry_failing_command(self):
+        """Ensure a command printing docker-like errors isn't run again."""
+        bench = self._get_test_bench()
+        commands = []
+        output = "Error: MariaDB server is not running\nNo such container"
+
+        def execute(command, input=None, non_zero_throw=True):
+            commands.append(command)
+            if command[:3] == ["docker", "service", "ps"]:
+                return {"output": "task", "returncode": 0}
+            data = {"output": output, "returncode": 1}
+            if non_zero_throw:
+                raise AgentException(data)
+            return data
+
+        with patch.dict(Bench._worker_containers, clear=True), patch.object(
+            bench, "execute", new=execute
+        ):
+            with self.assertRaises(AgentException):
+                bench.docker_execute("bench --site x backup --with-files")
+            result = bench.docker_execute(
+                "bench --site x backup", non_zero_throw=False, shell=True
+            )
+
+        self.assertEqual(result["output"], output)
+        service_lookups = [c for c in commands if c[1] == "service"]
+        self.assertEqual(len(service_lookups), 1)
+        self.assertEqual(len(commands), 3)
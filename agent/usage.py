@@ -2,6 +2,7 @@ import json
 import os
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from agent.server import Server
@@ -28,7 +29,6 @@ def get_traceback():
 
 
 if __name__ == "__main__":
-    info = []
     server = Server()
     time = datetime.utcnow().isoformat()
     target_file = os.path.join(
@@ -37,20 +37,30 @@ if __name__ == "__main__":
         f"{server.name}-usage-{time}.json.log",
     )
 
-    for bench in server.benches.values():
-        for site in bench.sites.values():
-            try:
-                info.append(
-                    {
-                        "site": site.name,
-                        "timestamp": str(datetime.utcnow()),
-                        "timezone": site.timezone,
-                        **site.get_usage(),
-                    }
-                )
-            except Exception:
-                error_log = f"ERROR [{site.name}:{time}]: {get_traceback()}"
-                print(error_log, file=sys.stderr)
+    def get_site_usage(site):
+        try:
+            return {
+                "site": site.name,
+                "timestamp": str(datetime.utcnow()),
+                "timezone": site.timezone,
+                **site.get_usage(),
+            }
+        except Exception:
+            error_log = f"ERROR [{site.name}:{time}]: {get_traceback()}"
+            print(error_log, file=sys.stderr)
+
+    sites = [
+        site
+        for bench in server.benches.values()
+        for site in bench.sites.values()
+    ]
+    # Every site is a few round trips to the database server and a walk of
+    # its folders. Cap the pool so the database server isn't flooded with
+    # information_schema queries
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        info = [
+            usage for usage in executor.map(get_site_usage, sites) if usage
+        ]
 
     with open(target_file, "w") as f:
         json.dump(info, f, indent=1)
@@ -1,9 +1,15 @@
+import json
 import os
 from urllib.parse import urlparse
 from math import ceil
 
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def download_file(url, prefix):
     """Download file locally under path prefix and return local path"""
@@ -25,14 +31,17 @@ def get_size(folder):
     """Returns the size of the folder in bytes. Ignores symlinks"""
     total_size = os.path.getsize(folder)
 
-    for item in os.listdir(folder):
-        itempath = os.path.join(folder, item)
-
-        if not os.path.islink(itempath):
-            if os.path.isfile(itempath):
-                total_size += os.path.getsize(itempath)
-            elif os.path.isdir(itempath):
-                total_size += get_size(itempath)
+    # DirEntry knows the file type from the directory listing, so only the
+    # size needs a stat call
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    total_size += entry.stat(follow_symlinks=False).st_size
+                    folders.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total_size += entry.stat(follow_symlinks=False).st_size
 
     return total_size
 
@@ -49,3 +58,43 @@ def cint(x):
 def b2mb(x):
     """Return B value in MiB"""
     return ceil(cint(x) / (1024**2))
+
+
+def json_loads(data):
+    """Parse JSON str or bytes, using orjson if available
+
+    Documents orjson rejects but stdlib json accepts (NaN, Infinity) fall
+    back to stdlib json. orjson parses integers wider than 64 bits as
+    floats, use stdlib json where those must round trip, e.g. configs.
+    """
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def json_dumps(value, default=None, indent=None, sort_keys=False):
+    """Serialize value to a JSON str, using orjson if available
+
+    orjson only supports indenting with 2 spaces, so any truthy indent
+    produces that. datetimes are still passed to default, so default=str
+    keeps the format stdlib json produced. Values orjson rejects but
+    stdlib json accepts (lone surrogates, integers wider than 64 bits)
+    fall back to stdlib json.
+    """
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(value, default=default, option=option).decode()
+        except TypeError:
+            pass
+
+    return json.dumps(
+        value, default=default, indent=indent, sort_keys=sort_keys
+    )
@@ -1234,6 +1234,7 @@ def docker_execute(bench: str):
         command=data.get("command"),
         subdir=data.get("subdir"),
         non_zero_throw=False,
+        shell=True,
     )
 
     result["start"] = result["start"].isoformat()